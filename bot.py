@@ -1,12 +1,15 @@
 import os
-import json
 import time
+import atexit
+import asyncio
 import random
 import logging
-from datetime import datetime
-from typing import Optional, Dict, Any, List
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, Any, List, BinaryIO, Set, Tuple
 
-import requests
+import aiohttp
+import orjson
 from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
 
@@ -17,7 +20,25 @@ from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
 # Either set your token here OR via environment variable BOT_TOKEN
 BOT_TOKEN = os.getenv("BOT_TOKEN", "YOUR_TELEGRAM_TOKEN_HERE")
 
-POSITIONS_FILE = "positions.json"
+# Append-only log of position changes; positions.json is the pre-log format
+POSITIONS_FILE = "positions.jsonl"
+LEGACY_POSITIONS_FILE = "positions.json"
+# Compact the log once it holds more than max(this, 2x live positions) records
+POSITIONS_COMPACT_MIN = 1000
+# Seconds between background persistence runs (log compaction, fsync, cache flushes)
+PERSIST_INTERVAL = 60
+# Set FSYNC=0 to skip fsync on writes (faster, but a power loss may drop recent changes)
+FSYNC = os.getenv("FSYNC", "1") != "0"
+WRITE_BUFFER_SIZE = 65536
+
+# Symbol -> CoinGecko id results of /search, kept across restarts
+TOKEN_IDS_FILE = "token_ids.json"
+# Seconds a symbol that /search could not resolve is not looked up again
+NEG_TTL = 300
+
+# Daily historical prices; they never change, so they are cached forever
+HIST_FILE = "hist_prices.json"
+HIST_RANGE_DAYS = 365
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -25,13 +46,48 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-session = requests.Session()
-
-PRICE_CACHE: Dict[str, Dict[str, Any]] = {}
-PRICE_TTL = 20
-
-MCAP_CACHE: Dict[str, Dict[str, Any]] = {}
-MCAP_TTL = 60
+# Shared aiohttp session, created on first use inside the bot's event loop
+AIO_SESSION: Optional[aiohttp.ClientSession] = None
+# Max simultaneous connections to CoinGecko
+HTTP_CONCURRENCY = 8
+
+# Response cache: key -> (expires_at, etag, last_modified, body). Entries are
+# fresh for the Cache-Control max-age, then revalidated with ETag /
+# Last-Modified; callers can opt in to stale bodies when CoinGecko errors out.
+HTTP_CACHE: Dict[str, Tuple[float, Optional[str], Optional[str], Any]] = {}
+HTTP_CACHE_MAX_ENTRIES = 256
+
+# CoinGecko free tier allows ~30 calls/min; stay a bit under it
+CG_RATE_PER_MIN = int(os.getenv("CG_RATE_PER_MIN", "25"))
+# Retries for 429 responses, waiting Retry-After or an exponential backoff
+MAX_RETRIES = 3
+MAX_BACKOFF = 60
+# Total seconds of retry waits allowed: short inside command handlers, which
+# python-telegram-bot processes one at a time, longer in background jobs
+HANDLER_RETRY_BUDGET = 5
+BACKGROUND_RETRY_BUDGET = MAX_RETRIES * MAX_BACKOFF
+
+# Upper-case symbol -> (price, fetched_at)
+PRICE_CACHE: Dict[str, Tuple[float, float]] = {}
+# Cache lifetimes in seconds; CoinGecko prices barely move within a few minutes
+PRICE_TTL = int(os.getenv("PRICE_TTL", "300"))
+
+# Symbols held by any user; their prices are refreshed in the background
+ACTIVE_SYMBOLS: Set[str] = set()
+PRICE_REFRESH_INTERVAL = 60
+
+# Max ids per /coins/markets call, keeps the query string well under URL length limits
+MARKETS_BATCH_SIZE = 150
+
+# Upper-case symbol -> (market cap, fetched_at)
+MCAP_CACHE: Dict[str, Tuple[float, float]] = {}
+MCAP_TTL = int(os.getenv("MCAP_TTL", "900"))
+
+# CoinGecko id -> expiry timestamp for ids /coins/markets returned nothing for
+PRICE_NEG_CACHE: Dict[str, float] = {}
+
+# CoinGecko id -> display name, filled from /coins/markets responses
+TOKEN_NAMES: Dict[str, str] = {}
 
 # Some common mappings to avoid extra CoinGecko search calls
 CG_MAPPING: Dict[str, str] = {
@@ -70,233 +126,724 @@ CG_MAPPING: Dict[str, str] = {
 # STORAGE (JSON)
 # ===========================
 
-def load_all_positions() -> Dict[str, List[Dict[str, Any]]]:
-    if not os.path.exists(POSITIONS_FILE):
+def _load_json(path: str) -> Dict[str, Any]:
+    if not os.path.exists(path):
         return {}
     try:
-        with open(POSITIONS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
     except Exception as e:
-        logger.warning(f"Error loading positions.json: {e}")
+        logger.warning("Error loading %s: %s", path, e)
         return {}
 
 
-def save_all_positions(data: Dict[str, List[Dict[str, Any]]]) -> None:
+def _fsync(f: BinaryIO) -> None:
+    if FSYNC:
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _write_file(path: str, data: bytes) -> None:
+    with open(path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(data)
+        _fsync(f)
+
+
+def _write_bytes_atomic(path: str, data: bytes) -> None:
+    tmp = path + ".tmp"
+    try:
+        _write_file(tmp, data)
+        os.replace(tmp, path)
+    except Exception as e:
+        logger.warning("Error saving %s: %s", path, e)
+
+
+def _write_json_atomic(path: str, data: Any) -> None:
+    _write_bytes_atomic(path, orjson.dumps(data))
+
+
+def _apply_record(data: Dict[str, List[Dict[str, Any]]], rec: Dict[str, Any]) -> None:
+    op = rec["op"]
+    key = str(rec["user"])
+    if op == "add":
+        data.setdefault(key, []).append(rec["pos"])
+    elif op == "clear":
+        data.pop(key, None)
+    elif op == "remove":
+        data[key] = [p for p in data.get(key, []) if p.get("symbol") != rec["symbol"]]
+    else:
+        raise ValueError(f"unknown op {op!r}")
+
+
+def load_all_positions() -> Dict[str, List[Dict[str, Any]]]:
+    """Rebuild the positions dict by replaying the log (or the legacy positions.json)."""
+    global _LOG_RECORDS, _LOG_NEEDS_REPAIR
+    if not os.path.exists(POSITIONS_FILE):
+        return _load_json(LEGACY_POSITIONS_FILE)
+
+    data: Dict[str, List[Dict[str, Any]]] = {}
+    try:
+        with open(POSITIONS_FILE, "rb") as f:
+            line = b""
+            for lineno, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    _apply_record(data, orjson.loads(line))
+                except Exception as e:
+                    # Typically a torn last line after a crash
+                    logger.warning("Skipping bad record %d in %s: %s", lineno, POSITIONS_FILE, e)
+                    _LOG_NEEDS_REPAIR = True
+                    continue
+                _LOG_RECORDS += 1
+            if line and not line.endswith(b"\n"):
+                # Appending after a partial line would merge the next record into it
+                _LOG_NEEDS_REPAIR = True
+    except Exception as e:
+        logger.warning("Error loading %s: %s", POSITIONS_FILE, e)
+    return data
+
+
+def _append_record(rec: Dict[str, Any]) -> None:
+    global _LOG, _LOG_RECORDS, _LOG_UNSYNCED
+    try:
+        if _LOG is None:
+            _LOG = open(POSITIONS_FILE, "ab")
+        _LOG.write(orjson.dumps(rec) + b"\n")
+        _LOG.flush()
+        _LOG_RECORDS += 1
+        _LOG_UNSYNCED = True
+    except Exception as e:
+        logger.warning("Error appending to %s: %s", POSITIONS_FILE, e)
+
+
+def sync_positions_log() -> None:
+    """fsync appended records; run from the persistence job so the cost is shared by many appends."""
+    global _LOG_UNSYNCED
+    if _LOG is None or not _LOG_UNSYNCED:
+        return
+    _LOG_UNSYNCED = False
+    try:
+        _fsync(_LOG)
+    except Exception as e:
+        logger.warning("Error syncing %s: %s", POSITIONS_FILE, e)
+
+
+async def _sync_positions_log_async() -> None:
+    global _LOG_UNSYNCED
+    if _LOG is None or not _LOG_UNSYNCED:
+        return
+    _LOG_UNSYNCED = False
+    try:
+        await asyncio.to_thread(_fsync, _LOG)
+    except Exception as e:
+        logger.warning("Error syncing %s: %s", POSITIONS_FILE, e)
+
+
+def _positions_snapshot() -> bytes:
+    """The live positions as a log of "add" records."""
+    return b"".join(
+        orjson.dumps({"op": "add", "user": key, "pos": pos}) + b"\n"
+        for key, positions in POSITIONS.items()
+        for pos in positions
+    )
+
+
+def _swap_in_snapshot(tmp: str) -> None:
+    global _LOG
+    if _LOG is not None:
+        _LOG.close()
+        _LOG = None
+    os.replace(tmp, POSITIONS_FILE)
+
+
+def _compaction_due(live: int) -> bool:
+    return _LOG_RECORDS > max(POSITIONS_COMPACT_MIN, 2 * live)
+
+
+def compact_positions(force: bool = False) -> None:
+    """Rewrite the log as a snapshot of the live positions once it has grown too large."""
+    global _LOG_RECORDS
+    live = sum(len(v) for v in POSITIONS.values())
+    if not force and not _compaction_due(live):
+        return
+
+    tmp = POSITIONS_FILE + ".tmp"
+    try:
+        _write_file(tmp, _positions_snapshot())
+        _swap_in_snapshot(tmp)
+    except Exception as e:
+        logger.warning("Error compacting %s: %s", POSITIONS_FILE, e)
+        return
+    _LOG_RECORDS = live
+
+
+async def _compact_positions_async() -> None:
+    """compact_positions() for the event loop: the snapshot is written and fsynced in a worker thread."""
+    global _LOG_RECORDS
+    live = sum(len(v) for v in POSITIONS.values())
+    if not _compaction_due(live):
+        return
+
+    records = _LOG_RECORDS
+    tmp = POSITIONS_FILE + ".tmp"
     try:
-        with open(POSITIONS_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2)
+        await asyncio.to_thread(_write_file, tmp, _positions_snapshot())
+        if _LOG_RECORDS != records:
+            # A command appended while the snapshot was written; try again next run
+            return
+        _swap_in_snapshot(tmp)
     except Exception as e:
-        logger.warning(f"Error saving positions.json: {e}")
+        logger.warning("Error compacting %s: %s", POSITIONS_FILE, e)
+        return
+    _LOG_RECORDS = live
+
+
+def _close_positions_log() -> None:
+    global _LOG
+    compact_positions()
+    sync_positions_log()
+    if _LOG is not None:
+        _LOG.close()
+        _LOG = None
+
+
+# In-memory store, rebuilt from the append-only log at startup. Every
+# mutation appends one record; the log is periodically compacted.
+_LOG: Optional[BinaryIO] = None
+_LOG_RECORDS = 0
+_LOG_UNSYNCED = False
+_LOG_NEEDS_REPAIR = False
+POSITIONS: Dict[str, List[Dict[str, Any]]] = load_all_positions()
+if _LOG_NEEDS_REPAIR or (POSITIONS and not os.path.exists(POSITIONS_FILE)):
+    # Rewrite a damaged log, or migrate a legacy positions.json, before the first append
+    compact_positions(force=True)
+
+atexit.register(_close_positions_log)
+
+# Symbol -> CoinGecko id, seeded from CG_MAPPING and grown by /search results
+SYMBOL_TO_ID: Dict[str, str] = {**_load_json(TOKEN_IDS_FILE), **CG_MAPPING}
+# Symbol -> expiry timestamp for symbols /search could not resolve
+NEG_CACHE: Dict[str, float] = {}
+_TOKEN_IDS_DIRTY = False
+
+
+def flush_token_ids() -> None:
+    global _TOKEN_IDS_DIRTY
+    if not _TOKEN_IDS_DIRTY:
+        return
+    _TOKEN_IDS_DIRTY = False
+    _write_json_atomic(TOKEN_IDS_FILE, SYMBOL_TO_ID)
+
+
+# CoinGecko id -> {"YYYY-MM-DD": USD price at 00:00 UTC}
+HIST_CACHE: Dict[str, Dict[str, float]] = _load_json(HIST_FILE)
+_HIST_DIRTY = False
+# (CoinGecko id, year) -> end of the range already fetched for that year
+_RANGES_FETCHED: Dict[Tuple[str, int], datetime] = {}
+
+
+def flush_hist_prices() -> None:
+    global _HIST_DIRTY
+    if not _HIST_DIRTY:
+        return
+    _HIST_DIRTY = False
+    _write_json_atomic(HIST_FILE, HIST_CACHE)
+
+
+def _expire_negative_caches() -> None:
+    """Drop expired NEG_CACHE / PRICE_NEG_CACHE entries; lookups only compare, never delete."""
+    now = time.time()
+    for cache in (NEG_CACHE, PRICE_NEG_CACHE):
+        for key in [k for k, expires in cache.items() if expires <= now]:
+            del cache[key]
+
+
+async def _persist_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Snapshots are serialized here on the loop, so handlers can't mutate them
+    # mid-write; the file writes and fsyncs run in worker threads.
+    global _TOKEN_IDS_DIRTY, _HIST_DIRTY
+    _expire_negative_caches()
+    await _compact_positions_async()
+    await _sync_positions_log_async()
+    if _TOKEN_IDS_DIRTY:
+        _TOKEN_IDS_DIRTY = False
+        await asyncio.to_thread(_write_bytes_atomic, TOKEN_IDS_FILE, orjson.dumps(SYMBOL_TO_ID))
+    if _HIST_DIRTY:
+        _HIST_DIRTY = False
+        await asyncio.to_thread(_write_bytes_atomic, HIST_FILE, orjson.dumps(HIST_CACHE))
+
+
+atexit.register(flush_token_ids)
+atexit.register(flush_hist_prices)
 
 
 def add_user_position(user_id: int, symbol: str, amount: float, buy_price: float) -> None:
-    all_data = load_all_positions()
     key = str(user_id)
-    all_data.setdefault(key, []).append(
-        {
-            "symbol": symbol.upper(),
-            "amount": amount,
-            "buy_price": buy_price,
-            "created_at": datetime.utcnow().isoformat() + "Z",
-        }
-    )
-    save_all_positions(all_data)
+    pos = {
+        "symbol": symbol,
+        "amount": amount,
+        "buy_price": buy_price,
+        "created_at": datetime.utcnow().isoformat() + "Z",
+    }
+    POSITIONS.setdefault(key, []).append(pos)
+    _append_record({"op": "add", "user": key, "pos": pos})
 
 
 def get_user_positions(user_id: int) -> List[Dict[str, Any]]:
-    all_data = load_all_positions()
-    return all_data.get(str(user_id), [])
+    return POSITIONS.get(str(user_id), [])
+
+
+def clear_user_positions(user_id: int) -> bool:
+    """Drop all positions of a user. Returns False if there was nothing to clear."""
+    key = str(user_id)
+    if not POSITIONS.get(key):
+        return False
+    del POSITIONS[key]
+    _append_record({"op": "clear", "user": key})
+    return True
+
+
+def remove_user_positions(user_id: int, symbol: str) -> bool:
+    """Drop all positions of one symbol. Returns False if none matched."""
+    key = str(user_id)
+    positions = POSITIONS.get(key, [])
+    new_positions = [p for p in positions if p.get("symbol") != symbol]
+    if len(new_positions) == len(positions):
+        return False
+    POSITIONS[key] = new_positions
+    _append_record({"op": "remove", "user": key, "symbol": symbol})
+    return True
 
 
 # ===========================
 # HTTP + COINGECKO HELPERS
 # ===========================
 
-def safe_get(
-    url: str,
-    params: Optional[Dict[str, Any]] = None,
-    timeout: int = 10,
-) -> Optional[requests.Response]:
-    """Simple wrapper to avoid crashes on HTTP errors."""
+# Symbol arguments are expected upper-case and stripped, the form command
+# handlers normalize user input to and positions are stored in.
+
+class RateLimiter:
+    """Token bucket allowing at most `rate_per_min` calls in any 60s window; acquire() waits when empty.
+
+    Any 60s window can see a full bucket plus one minute of refill, so the
+    bucket stays small and refills at the remaining rate.
+    """
+
+    def __init__(self, rate_per_min: int, burst: int = 3):
+        # One token of bucket plus one per minute of refill is the smallest workable split
+        if rate_per_min < 2:
+            raise ValueError(f"rate_per_min must be at least 2, got {rate_per_min}")
+        self.capacity = max(1, min(burst, rate_per_min - 1))
+        self.rate = rate_per_min - self.capacity
+        self.tokens = float(self.capacity)
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate / 60)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            wait = (1 - self.tokens) * 60 / self.rate
+            await asyncio.sleep(wait)
+            self.tokens = 0.0
+            self.last = time.monotonic()
+
+
+_limiter = RateLimiter(CG_RATE_PER_MIN)
+
+
+def _http_session() -> aiohttp.ClientSession:
+    global AIO_SESSION
+    if AIO_SESSION is None or AIO_SESSION.closed:
+        AIO_SESSION = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=HTTP_CONCURRENCY))
+    return AIO_SESSION
+
+
+async def close_http_session(app: Any = None) -> None:
+    if AIO_SESSION is not None and not AIO_SESSION.closed:
+        await AIO_SESSION.close()
+
+
+def _retry_delay(r: aiohttp.ClientResponse, attempt: int) -> float:
     try:
-        r = session.get(url, params=params, timeout=timeout)
-    except Exception as e:
-        logger.warning(f"Request error for {url}: {e}")
-        return None
+        delay = float(r.headers.get("Retry-After", ""))
+    except ValueError:
+        delay = 2 ** attempt
+    return min(max(delay, 0.0), MAX_BACKOFF)
 
-    if r.status_code != 200:
-        logger.warning(f"{url} returned status {r.status_code}")
-        return None
 
-    return r
+def _cache_key(url: str, params: Optional[Dict[str, Any]]) -> str:
+    if not params:
+        return url
+    return url + "?" + "&".join(f"{k}={v}" for k, v in sorted(params.items()))
 
 
-def resolve_token_id(symbol: str) -> Optional[str]:
-    sym = symbol.lower().strip()
-    if sym in CG_MAPPING:
-        return CG_MAPPING[sym]
+def _max_age(r: aiohttp.ClientResponse) -> Optional[float]:
+    """Freshness lifetime from Cache-Control; None means the response must not be cached."""
+    directives = [d.strip().lower() for d in r.headers.get("Cache-Control", "").split(",")]
+    if "no-store" in directives:
+        return None
+    for d in directives:
+        if d.startswith("max-age="):
+            try:
+                return float(d[8:])
+            except ValueError:
+                break
+    # No max-age: keep the body for revalidation and errors, but never serve it unchecked
+    return 0.0
+
+
+def _store_response(key: str, r: aiohttp.ClientResponse, body: Any) -> None:
+    max_age = _max_age(r)
+    old = HTTP_CACHE.pop(key, None)
+    if max_age is None:
+        return
+    # A 304 may omit the validators; keep the ones from the original response
+    etag = r.headers.get("ETag") or (old[1] if old else None)
+    last_modified = r.headers.get("Last-Modified") or (old[2] if old else None)
+    if len(HTTP_CACHE) >= HTTP_CACHE_MAX_ENTRIES:
+        # Dicts keep insertion order, so the first key is the least recently stored
+        del HTTP_CACHE[next(iter(HTTP_CACHE))]
+    HTTP_CACHE[key] = (time.time() + max_age, etag, last_modified, body)
+
+
+async def safe_get(
+    url: str,
+    params: Optional[Dict[str, Any]] = None,
+    timeout: int = 10,
+    cache: bool = True,
+    stale_ok: bool = False,
+    retry_budget: float = HANDLER_RETRY_BUDGET,
+) -> Optional[Any]:
+    """GET a JSON endpoint; returns the decoded body, or None on any HTTP error.
+
+    Fresh responses are served from HTTP_CACHE without a request; stale ones are
+    revalidated with ETag / Last-Modified. With stale_ok=True a stale body is
+    returned if the request fails; leave it off for data that must be current.
+    Pass cache=False for responses that are cached elsewhere. 429 retries stop
+    once their waits would exceed retry_budget seconds.
+    """
+    key = _cache_key(url, params)
+    cached = HTTP_CACHE.get(key) if cache else None
+    if cached and time.time() < cached[0]:
+        return cached[3]
+
+    headers: Dict[str, str] = {}
+    if cached:
+        if cached[1]:
+            headers["If-None-Match"] = cached[1]
+        if cached[2]:
+            headers["If-Modified-Since"] = cached[2]
+    stale = cached[3] if cached and stale_ok else None
+
+    waited = 0.0
+    for attempt in range(MAX_RETRIES + 1):
+        await _limiter.acquire()
+        try:
+            async with _http_session().get(
+                url, params=params, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as r:
+                if r.status == 304 and cached:
+                    _store_response(key, r, cached[3])
+                    return cached[3]
+                if r.status == 429 and attempt < MAX_RETRIES:
+                    delay = _retry_delay(r, attempt)
+                    if waited + delay > retry_budget:
+                        logger.warning("%s rate limited, giving up", url)
+                        return stale
+                elif r.status != 200:
+                    logger.warning("%s returned status %s", url, r.status)
+                    return stale
+                else:
+                    body = orjson.loads(await r.read())
+                    if cache:
+                        _store_response(key, r, body)
+                    return body
+        except Exception as e:
+            logger.warning("Request error for %s: %s", url, e)
+            return stale
+
+        logger.warning("%s rate limited, retrying in %.0fs", url, delay)
+        await asyncio.sleep(delay)
+        waited += delay
+
+    return stale
+
+
+async def resolve_token_id(symbol: str) -> Optional[str]:
+    global _TOKEN_IDS_DIRTY
+    sym = symbol.lower()
+    token_id = SYMBOL_TO_ID.get(sym)
+    if token_id:
+        return token_id
+    if NEG_CACHE.get(sym, 0) > time.time():
+        return None
 
     url = "https://api.coingecko.com/api/v3/search"
-    r = safe_get(url, params={"query": sym})
-    if r is None:
+    # Symbol -> id mappings don't go out of date, so an old answer beats none
+    data = await safe_get(url, params={"query": sym}, stale_ok=True)
+    if data is None:
         return None
 
     try:
-        coins = (r.json() or {}).get("coins", [])
+        coins = (data or {}).get("coins", [])
     except Exception:
         return None
 
     if not coins:
+        NEG_CACHE[sym] = time.time() + NEG_TTL
         return None
 
     for c in coins:
         if c.get("symbol", "").lower() == sym:
-            return c.get("id")
+            token_id = c.get("id")
+            break
+    else:
+        token_id = coins[0].get("id")
 
-    return coins[0].get("id")
+    if token_id:
+        SYMBOL_TO_ID[sym] = token_id
+        _TOKEN_IDS_DIRTY = True
+    return token_id
 
 
-def get_token_name(symbol: str) -> Optional[str]:
-    token_id = resolve_token_id(symbol)
-    if not token_id:
-        return None
+async def _fetch_markets_batch(batch: List[str], retry_budget: float) -> Optional[List[Dict[str, Any]]]:
+    url = "https://api.coingecko.com/api/v3/coins/markets"
+    params = {
+        "vs_currency": "usd",
+        "ids": ",".join(batch),
+        "per_page": len(batch),
+        "price_change_percentage": "24h",
+    }
+    data = await safe_get(url, params=params, retry_budget=retry_budget)
+    return data if isinstance(data, list) else None
 
-    url = f"https://api.coingecko.com/api/v3/coins/{token_id}"
-    r = safe_get(url)
-    if r is None:
-        return None
 
-    try:
-        return (r.json() or {}).get("name")
-    except Exception:
-        return None
+async def fetch_markets(
+    token_ids: List[str],
+    retry_budget: float = HANDLER_RETRY_BUDGET,
+) -> Dict[str, Dict[str, Any]]:
+    """Price, market cap, 24h change and ATH for many ids via /coins/markets, one call per batch."""
+    now = time.time()
+    token_ids = [t for t in token_ids if PRICE_NEG_CACHE.get(t, 0) <= now]
+    batches = [token_ids[i:i + MARKETS_BATCH_SIZE] for i in range(0, len(token_ids), MARKETS_BATCH_SIZE)]
+    markets: Dict[str, Dict[str, Any]] = {}
 
+    results = await asyncio.gather(*(_fetch_markets_batch(b, retry_budget) for b in batches))
+    for batch, rows in zip(batches, results):
+        if rows is None:
+            continue
+        for row in rows:
+            token_id = row.get("id")
+            if not token_id:
+                continue
+            if row.get("name"):
+                TOKEN_NAMES[token_id] = row["name"]
+            markets[token_id] = {
+                "price": row.get("current_price"),
+                "mcap": row.get("market_cap"),
+                "change24h": row.get("price_change_percentage_24h"),
+                "ath": row.get("ath"),
+                "ath_date": row.get("ath_date"),
+            }
+        # Ids CoinGecko has no market data for (e.g. delisted) are not retried for a while
+        for token_id in batch:
+            if token_id not in markets:
+                PRICE_NEG_CACHE[token_id] = now + NEG_TTL
+
+    return markets
+
+
+async def _refresh_markets(
+    symbols: List[str],
+    retry_budget: float = HANDLER_RETRY_BUDGET,
+) -> Dict[str, Dict[str, Any]]:
+    """Fetch market data for the given symbols, store it in PRICE_CACHE / MCAP_CACHE and return it by id."""
+    symbols = list(dict.fromkeys(symbols))
+    token_ids = await asyncio.gather(*(resolve_token_id(s) for s in symbols))
+    by_id: Dict[str, List[str]] = {}
+    for symbol, token_id in zip(symbols, token_ids):
+        if token_id:
+            by_id.setdefault(token_id, []).append(symbol)
+    if not by_id:
+        return {}
 
-def get_current_price_usd(symbol: str) -> Optional[float]:
-    sym_up = symbol.upper()
     now = time.time()
-    cached = PRICE_CACHE.get(sym_up)
-    if cached and now - cached["ts"] < PRICE_TTL:
-        return cached["price"]
-
-    token_id = resolve_token_id(symbol)
+    markets = await fetch_markets(list(by_id), retry_budget)
+    for token_id, market in markets.items():
+        for sym_up in by_id.get(token_id, []):
+            if market["price"] is not None:
+                PRICE_CACHE[sym_up] = (market["price"], now)
+            if market["mcap"] is not None:
+                MCAP_CACHE[sym_up] = (market["mcap"], now)
+    return markets
+
+
+async def get_token_name(symbol: str) -> Optional[str]:
+    token_id = await resolve_token_id(symbol)
     if not token_id:
         return None
 
-    url = "https://api.coingecko.com/api/v3/simple/price"
-    r = safe_get(url, params={"ids": token_id, "vs_currencies": "usd"})
-    if r is None:
+    if token_id not in TOKEN_NAMES:
+        await _refresh_markets([symbol])
+    return TOKEN_NAMES.get(token_id)
+
+
+async def get_current_price_usd(symbol: str) -> Optional[float]:
+    return (await get_current_prices_usd([symbol])).get(symbol)
+
+
+async def get_current_prices_usd(symbols: List[str]) -> Dict[str, float]:
+    """Current prices keyed by upper-case symbol; all cache misses share one markets request."""
+    now = time.time()
+    prices: Dict[str, float] = {}
+    missing: List[str] = []
+
+    for symbol in symbols:
+        cached = PRICE_CACHE.get(symbol)
+        if cached and now - cached[1] < PRICE_TTL:
+            prices[symbol] = cached[0]
+        else:
+            missing.append(symbol)
+
+    if missing:
+        await _refresh_markets(missing)
+        for symbol in missing:
+            cached = PRICE_CACHE.get(symbol)
+            if cached:
+                prices[symbol] = cached[0]
+
+    return prices
+
+
+async def _refresh_prices_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Keep PRICE_CACHE warm for held symbols so /portfolio rarely waits on CoinGecko."""
+    if ACTIVE_SYMBOLS:
+        await _refresh_markets(list(ACTIVE_SYMBOLS), BACKGROUND_RETRY_BUDGET)
+
+
+def _release_symbols(symbols: List[str]) -> None:
+    """Stop refreshing symbols that no user holds any more."""
+    held = {p["symbol"] for positions in POSITIONS.values() for p in positions}
+    for symbol in symbols:
+        if symbol not in held:
+            ACTIVE_SYMBOLS.discard(symbol)
+
+
+async def _fetch_daily_prices(token_id: str, start: datetime, end: datetime) -> Optional[Dict[str, float]]:
+    """First price of every UTC day in [start, end) from /market_chart/range; None if the call failed."""
+    url = f"https://api.coingecko.com/api/v3/coins/{token_id}/market_chart/range"
+    params = {"vs_currency": "usd", "from": int(start.timestamp()), "to": int(end.timestamp())}
+    # Historical prices live in HIST_CACHE; don't keep the raw range payload too
+    data = await safe_get(url, params=params, cache=False)
+    if data is None:
         return None
 
+    daily: Dict[str, float] = {}
     try:
-        data = r.json()
-        price = data.get(token_id, {}).get("usd")
+        for ts_ms, price in (data or {}).get("prices", []):
+            day = datetime.fromtimestamp(ts_ms / 1000, tz=timezone.utc).strftime("%Y-%m-%d")
+            daily.setdefault(day, price)
     except Exception:
         return None
+    return daily
 
-    if price is None:
-        return None
-
-    PRICE_CACHE[sym_up] = {"price": price, "ts": now}
-    return price
 
-
-def get_historical_price_usd(symbol: str, date_str: str) -> Optional[float]:
-    token_id = resolve_token_id(symbol)
+async def get_historical_price_usd(symbol: str, date_str: str) -> Optional[float]:
+    global _HIST_DIRTY
+    token_id = await resolve_token_id(symbol)
     if not token_id:
         return None
 
     try:
-        dt = datetime.strptime(date_str, "%Y-%m-%d")
-        cg_date = dt.strftime("%d-%m-%Y")
+        dt = datetime.strptime(date_str, "%Y-%m-%d").replace(tzinfo=timezone.utc)
     except ValueError:
         return None
 
+    prices = HIST_CACHE.get(token_id, {})
+    if date_str in prices:
+        return prices[date_str]
+
+    # Only finished days are immutable; today's price is never cached
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    # The free API only serves ranges within the last HIST_RANGE_DAYS days
+    window_start = today - timedelta(days=HIST_RANGE_DAYS)
+    range_key = (token_id, dt.year)
+    covered_until = _RANGES_FETCHED.get(range_key)
+    if window_start <= dt < today and not (covered_until and dt < covered_until):
+        # One range call fills the rest of the year the date falls in
+        start = max(dt.replace(month=1, day=1), window_start)
+        end = min(dt.replace(year=dt.year + 1, month=1, day=1), today)
+        daily = await _fetch_daily_prices(token_id, start, end)
+        if daily is not None:
+            # Dates the range didn't return (e.g. before listing) go straight to /history next time
+            _RANGES_FETCHED[range_key] = end
+        if daily:
+            prices = HIST_CACHE.setdefault(token_id, {})
+            prices.update(daily)
+            _HIST_DIRTY = True
+            if date_str in prices:
+                return prices[date_str]
+
     url = f"https://api.coingecko.com/api/v3/coins/{token_id}/history"
-    r = safe_get(url, params={"date": cg_date})
-    if r is None:
+    data = await safe_get(url, params={"date": dt.strftime("%d-%m-%Y")}, cache=False)
+    if data is None:
         return None
 
     try:
-        data = r.json()
-        return data["market_data"]["current_price"]["usd"]
+        price = data["market_data"]["current_price"]["usd"]
     except Exception:
         return None
 
+    if dt < today:
+        HIST_CACHE.setdefault(token_id, {})[date_str] = price
+        _HIST_DIRTY = True
+    return price
 
-def get_token_market_cap(symbol: str) -> Optional[float]:
-    sym_up = symbol.upper()
-    now = time.time()
-    cached = MCAP_CACHE.get(sym_up)
-    if cached and now - cached["ts"] < MCAP_TTL:
-        return cached["mcap"]
 
-    token_id = resolve_token_id(symbol)
-    if not token_id:
-        return None
+async def get_token_market_cap(symbol: str) -> Optional[float]:
+    cached = MCAP_CACHE.get(symbol)
+    if not cached or time.time() - cached[1] >= MCAP_TTL:
+        await _refresh_markets([symbol])
+        cached = MCAP_CACHE.get(symbol)
+    return cached[0] if cached else None
 
-    url = "https://api.coingecko.com/api/v3/coins/markets"
-    params = {"vs_currency": "usd", "ids": token_id}
-    r = safe_get(url, params=params)
-    if r is None:
-        return None
 
-    try:
-        data = r.json()
-        if not data:
-            return None
-        mcap = data[0].get("market_cap")
-    except Exception:
-        return None
+# ===========================
+# FORMATTING & DEGEN SCORE
+# ===========================
 
-    if mcap is None:
-        return None
+# Ladders for bisect_right: value v falls in bucket bisect_right(BINS, v)
+_MCAP_BINS = [1_000, 1_000_000, 1_000_000_000]
+# (divisor, suffix, decimals) per bucket
+_MCAP_FMT = [(1, "", 0), (1_000, "K", 1), (1_000_000, "M", 1), (1_000_000_000, "B", 1)]
 
-    MCAP_CACHE[sym_up] = {"mcap": mcap, "ts": now}
-    return mcap
+_MCAP_RISK_BINS = [5_000_000, 50_000_000, 200_000_000, 1_000_000_000, 10_000_000_000]
+_MCAP_RISK_SCORES = [10.0, 8.0, 7.0, 5.0, 3.0, 1.0]
 
+_VOL_RISK_BINS = [2, 5, 10, 20]
+_VOL_RISK_SCORES = [2.0, 4.0, 6.0, 8.0, 10.0]
 
-# ===========================
-# FORMATTING & DEGEN SCORE
-# ===========================
 
 def format_mcap(value: Optional[float]) -> str:
     if value is None:
         return "N/A"
     v = float(value)
-    if v >= 1_000_000_000:
-        return f"${v / 1_000_000_000:.1f}B"
-    if v >= 1_000_000:
-        return f"${v / 1_000_000:.1f}M"
-    if v >= 1_000:
-        return f"${v / 1_000:.1f}K"
-    return f"${v:.0f}"
+    div, suffix, decimals = _MCAP_FMT[bisect_right(_MCAP_BINS, v)]
+    return f"${v / div:.{decimals}f}{suffix}"
 
 
 def _mcap_risk_score(mcap: float) -> float:
-    if mcap >= 10_000_000_000:
-        return 1.0
-    if mcap >= 1_000_000_000:
-        return 3.0
-    if mcap >= 200_000_000:
-        return 5.0
-    if mcap >= 50_000_000:
-        return 7.0
-    if mcap >= 5_000_000:
-        return 8.0
-    return 10.0
+    return _MCAP_RISK_SCORES[bisect_right(_MCAP_RISK_BINS, mcap)]
 
 
 def _vol_risk_score(abs_change_24h: float) -> float:
-    if abs_change_24h < 2:
-        return 2.0
-    if abs_change_24h < 5:
-        return 4.0
-    if abs_change_24h < 10:
-        return 6.0
-    if abs_change_24h < 20:
-        return 8.0
-    return 10.0
+    return _VOL_RISK_SCORES[bisect_right(_VOL_RISK_BINS, abs_change_24h)]
 
 
 def degen_score(mcap: Optional[float], change_24h: Optional[float]) -> Optional[Dict[str, Any]]:
@@ -330,13 +877,16 @@ def degen_score(mcap: Optional[float], change_24h: Optional[float]) -> Optional[
 # PNL CALC (WHATIFDATE ONLY)
 # ===========================
 
-def calc_what_if_date(symbol: str, usd_amount: float, date_str: str) -> Optional[Dict[str, Any]]:
-    buy_price = get_historical_price_usd(symbol, date_str)
-    if buy_price is None:
+async def calc_what_if_date(symbol: str, usd_amount: float, date_str: str) -> Optional[Dict[str, Any]]:
+    # Resolve once up front so the two lookups below don't both hit /search
+    if not await resolve_token_id(symbol):
         return None
 
-    current = get_current_price_usd(symbol)
-    if current is None:
+    buy_price, current = await asyncio.gather(
+        get_historical_price_usd(symbol, date_str),
+        get_current_price_usd(symbol),
+    )
+    if buy_price is None or current is None:
         return None
 
     tokens = usd_amount / buy_price
@@ -345,8 +895,8 @@ def calc_what_if_date(symbol: str, usd_amount: float, date_str: str) -> Optional
     pct = (profit / usd_amount * 100) if usd_amount else 0
 
     return {
-        "name": get_token_name(symbol) or symbol.upper(),
-        "symbol": symbol.upper(),
+        "name": await get_token_name(symbol) or symbol,
+        "symbol": symbol,
         "usd_amount": usd_amount,
         "tokens": tokens,
         "buy_price": buy_price,
@@ -364,6 +914,7 @@ def calc_what_if_date(symbol: str, usd_amount: float, date_str: str) -> Optional
 # ===========================
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    ttl = f"{PRICE_TTL // 60} min" if PRICE_TTL >= 60 and PRICE_TTL % 60 == 0 else f"{PRICE_TTL}s"
     msg = (
         "👋 *Welcome to the What-If Profit/Loss Bot!*\n\n"
         "Core commands:\n"
@@ -374,7 +925,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "• `/clear` – clear your portfolio\n"
         "• `/remove SYMBOL` – remove one token\n\n"
         "Extra:\n"
-        "• `/gm` – degen-style good morning\n"
+        "• `/gm` – degen-style good morning\n\n"
+        f"ℹ️ Prices may be up to {ttl} old to stay within CoinGecko's free rate limit.\n"
     )
     await update.message.reply_text(msg, parse_mode="Markdown")
 
@@ -389,7 +941,7 @@ async def whatifdate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         )
         return
 
-    symbol = args[0]
+    symbol = args[0].strip().upper()
     try:
         usd_amount = float(args[1])
     except ValueError:
@@ -403,12 +955,12 @@ async def whatifdate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         await update.message.reply_text("Date must be YYYY-MM-DD.")
         return
 
-    res = calc_what_if_date(symbol, usd_amount, date_str)
+    res = await calc_what_if_date(symbol, usd_amount, date_str)
     if res is None:
         await update.message.reply_text("Could not fetch historical/current price.")
         return
 
-    mcap = get_token_market_cap(res["symbol"])
+    mcap = await get_token_market_cap(res["symbol"])
     d = degen_score(mcap, None)
 
     emoji = "🟢" if res["profit_abs"] > 0 else ("🔴" if res["profit_abs"] < 0 else "⚪️")
@@ -442,7 +994,7 @@ async def addpos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
         return
 
-    symbol = args[0]
+    symbol = args[0].strip().upper()
     try:
         amount = float(args[1])
         buy_price = float(args[2])
@@ -456,12 +1008,26 @@ async def addpos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     add_user_position(user.id, symbol, amount, buy_price)
+    # Unresolvable symbols (typos) would re-hit /search on every refresh
+    if await resolve_token_id(symbol):
+        ACTIVE_SYMBOLS.add(symbol)
     await update.message.reply_text(
-        f"Saved: {amount:g} {symbol.upper()} @ ${buy_price:.4f}\nUse `/portfolio` to view PnL.",
+        f"Saved: {amount:g} {symbol} @ ${buy_price:.4f}\nUse `/portfolio` to view PnL.",
         parse_mode="Markdown",
     )
 
 
+# One /portfolio row; extra spacing + clearer layout
+_ROW_FMT = (
+    "{i}. {emo} *{sym}*\n"
+    "   • Amount: `{amt:g}`\n"
+    "   • Buy price: `${bp:.4f}`\n"
+    "   • Current price: `${cp:.4f}`\n"
+    "   • Value: `${cv:,.2f}`\n"
+    "   • PnL: `${pn:,.2f}` ({pct:.2f}%)"
+)
+
+
 async def portfolio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show portfolio with more spacing / readability."""
     user = update.effective_user
@@ -481,12 +1047,21 @@ async def portfolio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     total_current = 0.0
     lines: List[str] = []
 
+    # One batched price request instead of one per position
+    prices = await get_current_prices_usd([pos["symbol"] for pos in positions])
+    ACTIVE_SYMBOLS.update(prices)
+
+    # Local aliases for the per-row calls below
+    append = lines.append
+    get_price = prices.get
+    render = _ROW_FMT.format
+
     for idx, pos in enumerate(positions, start=1):
         sym = pos["symbol"]
         amount = float(pos["amount"])
         buy_price = float(pos["buy_price"])
 
-        current_price = get_current_price_usd(sym)
+        current_price = get_price(sym)
         if current_price is None:
             continue
 
@@ -500,16 +1075,19 @@ async def portfolio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
         emoji = "🟢" if profit_abs > 0 else ("🔴" if profit_abs < 0 else "⚪️")
 
-        # Extra spacing + clearer layout
-        line = (
-            f"{idx}. {emoji} *{sym}*\n"
-            f"   • Amount: `{amount:g}`\n"
-            f"   • Buy price: `${buy_price:.4f}`\n"
-            f"   • Current price: `${current_price:.4f}`\n"
-            f"   • Value: `${current_value:,.2f}`\n"
-            f"   • PnL: `${profit_abs:,.2f}` ({profit_pct:.2f}%)"
+        append(
+            render(
+                i=idx,
+                emo=emoji,
+                sym=sym,
+                amt=amount,
+                bp=buy_price,
+                cp=current_price,
+                cv=current_value,
+                pn=profit_abs,
+                pct=profit_pct,
+            )
         )
-        lines.append(line)
 
     total_profit = total_current - total_initial
     total_pct = (total_profit / total_initial * 100) if total_initial != 0 else 0
@@ -534,12 +1112,9 @@ async def clear(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("Could not get your user ID.")
         return
 
-    all_data = load_all_positions()
-    key = str(user.id)
-
-    if key in all_data and all_data[key]:
-        all_data[key] = []
-        save_all_positions(all_data)
+    symbols = [p["symbol"] for p in get_user_positions(user.id)]
+    if clear_user_positions(user.id):
+        _release_symbols(symbols)
         await update.message.reply_text("🗑️ Your entire portfolio has been cleared.")
     else:
         await update.message.reply_text("You don't have any saved positions yet.")
@@ -554,28 +1129,20 @@ async def remove(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
         return
 
-    symbol = args[0].upper()
+    symbol = args[0].strip().upper()
     user = update.effective_user
     if not user:
         await update.message.reply_text("Could not get your user ID.")
         return
 
-    all_data = load_all_positions()
-    key = str(user.id)
-    positions = all_data.get(key, [])
-
-    new_positions = [p for p in positions if p.get("symbol") != symbol]
-
-    if len(new_positions) == len(positions):
+    if not remove_user_positions(user.id, symbol):
         await update.message.reply_text(
             f"No `{symbol}` positions found in your portfolio.",
             parse_mode="Markdown",
         )
         return
 
-    all_data[key] = new_positions
-    save_all_positions(all_data)
-
+    _release_symbols([symbol])
     await update.message.reply_text(
         f"🗑️ Removed all `{symbol}` positions from your portfolio.",
         parse_mode="Markdown",
@@ -591,28 +1158,25 @@ async def ath(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
         return
 
-    symbol = args[0]
-    token_id = resolve_token_id(symbol)
+    symbol = args[0].strip().upper()
+    token_id = await resolve_token_id(symbol)
     if not token_id:
         await update.message.reply_text("Could not resolve that token symbol.")
         return
 
-    url = f"https://api.coingecko.com/api/v3/coins/{token_id}"
-    r = safe_get(url, params={"localization": "false"})
-    if r is None:
+    # /coins/markets carries the ATH fields too, and is far smaller than /coins/{id}
+    market = (await _refresh_markets([symbol])).get(token_id)
+    if market is None:
         await update.message.reply_text("Could not fetch ATH info.")
         return
 
-    try:
-        data = r.json()
-        name = data.get("name", symbol.upper())
-        md = data["market_data"]
-        ath_price = md["ath"]["usd"]
-        ath_date_iso = md["ath_date"]["usd"]
-        current_price = md["current_price"]["usd"]
-        mcap = md["market_cap"]["usd"]
-        change_24h = md.get("price_change_percentage_24h")
-    except Exception:
+    name = TOKEN_NAMES.get(token_id, symbol)
+    ath_price = market["ath"]
+    ath_date_iso = market["ath_date"]
+    current_price = market["price"]
+    mcap = market["mcap"]
+    change_24h = market["change24h"]
+    if ath_price is None or ath_date_iso is None or current_price is None:
         await update.message.reply_text("ATH data not available for this token.")
         return
 
@@ -631,7 +1195,7 @@ async def ath(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     d = degen_score(mcap, change_24h)
 
     text = (
-        f"📈 *All-Time High for {name} ({symbol.upper()})*\n\n"
+        f"📈 *All-Time High for {name} ({symbol})*\n\n"
         f"• ATH price: `${ath_price:,.4f}`\n"
         f"• ATH date: `{ath_date_str}`\n"
         f"• Current price: `${current_price:,.4f}`\n"
@@ -667,7 +1231,7 @@ def main() -> None:
     if BOT_TOKEN == "YOUR_TELEGRAM_BOT_TOKEN_HERE":
         raise RuntimeError("Please set your Telegram bot token in BOT_TOKEN or env var BOT_TOKEN.")
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    app = ApplicationBuilder().token(BOT_TOKEN).post_shutdown(close_http_session).build()
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("whatifdate", whatifdate))
@@ -678,6 +1242,18 @@ def main() -> None:
     app.add_handler(CommandHandler("ath", ath))
     app.add_handler(CommandHandler("gm", gm))
 
+    if app.job_queue is not None:
+        app.job_queue.run_repeating(_persist_job, interval=PERSIST_INTERVAL)
+        ACTIVE_SYMBOLS.update(
+            p["symbol"]
+            for positions in POSITIONS.values()
+            for p in positions
+            if p["symbol"].lower() in SYMBOL_TO_ID
+        )
+        app.job_queue.run_repeating(_refresh_prices_job, interval=PRICE_REFRESH_INTERVAL, first=5)
+    else:
+        logger.warning("JobQueue not available, persistence only runs on exit and prices are fetched on demand.")
+
     logger.info("What-If Profit/Loss Bot is running…")
     app.run_polling()
 